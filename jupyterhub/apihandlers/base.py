@@ -18,6 +18,13 @@ from ..utils import isoformat, url_escape_path, url_path_join
 
 PAGINATION_MEDIA_TYPE = "application/jupyterhub-pagination+json"
 
+try:
+    # prefer orjson when available: it parses bytes directly,
+    # skipping the UTF-8 decode stdlib json requires
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
 
 class APIHandler(BaseHandler):
     """Base class for API endpoints
@@ -112,9 +119,9 @@ class APIHandler(BaseHandler):
         """Return the body of the request as JSON data."""
         if not self.request.body:
             return None
-        body = self.request.body.strip().decode('utf-8')
+        body = self.request.body.strip()
         try:
-            model = json.loads(body)
+            model = _json_loads(body)
         except Exception:
             self.log.debug("Bad JSON: %r", body)
             self.log.error("Couldn't parse JSON", exc_info=True)
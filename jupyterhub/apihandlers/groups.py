@@ -86,23 +86,31 @@ class GroupListAPIHandler(_GroupAPIHandler):
         groupnames = model.pop("groups", [])
         self._check_group_model(model)
 
-        created = []
+        # check for conflicts with one query instead of one per group
+        existing = {
+            row.name
+            for row in self.db.query(orm.Group.name).filter(
+                orm.Group.name.in_(groupnames)
+            )
+        }
         for name in groupnames:
-            existing = orm.Group.find(self.db, name=name)
-            if existing is not None:
+            if name in existing:
                 raise web.HTTPError(409, f"Group {name} already exists")
+            existing.add(name)
+
+        usernames = model.get('users', [])
+        # check that users exist (once; the same users go in every group)
+        users = self._usernames_to_users(usernames)
 
-            usernames = model.get('users', [])
-            # check that users exist
-            users = self._usernames_to_users(usernames)
-            # create the group
+        created = []
+        for name in groupnames:
             self.log.info("Creating new group %s with %i users", name, len(users))
             self.log.debug("Users: %s", usernames)
             group = orm.Group(name=name)
             self.db.add(group)
-            group.users = users
-            self.db.commit()
+            group.users = list(users)
             created.append(group)
+        self.db.commit()
         self.write(json.dumps([self.group_model(group) for group in created]))
         self.set_status(201)
 
@@ -4,6 +4,7 @@
 # Distributed under the terms of the Modified BSD License.
 import json
 import sys
+from functools import lru_cache
 
 from tornado import web
 
@@ -11,6 +12,51 @@ from .._version import __version__
 from ..scopes import needs_scope
 from .base import APIHandler
 
+try:
+    # prefer orjson when available: it is much faster than stdlib json
+    # and returns bytes directly, skipping tornado's str->bytes encode
+    from orjson import dumps as _json_dumps
+except ImportError:
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf8")
+
+
+# the /api/ response never changes at runtime,
+# so serialize it once at import time
+_ROOT_JSON = _json_dumps({'version': __version__})
+_ROOT_JSON_LENGTH = str(len(_ROOT_JSON))
+_ROOT_ETAG = f'"{__version__}"'
+
+# interpreter facts are fixed at startup; bind them once
+# so the memoized info payload never sees a changed value
+_PY_VERSION = sys.version
+_SYS_EXECUTABLE = sys.executable
+
+
+@lru_cache(maxsize=1)
+def _jupyterhub_class():
+    """Resolve the JupyterHub application class exactly once
+
+    imported lazily to avoid an import cycle with ..app
+    """
+    from ..app import JupyterHub
+
+    return JupyterHub
+
+
+@lru_cache(maxsize=64)
+def _class_info(typ):
+    """info about a class (Spawner or Authenticator)"""
+    info = {'class': f'{typ.__module__}.{typ.__name__}'}
+    pkg = typ.__module__.split('.')[0]
+    try:
+        version = sys.modules[pkg].__version__
+    except (KeyError, AttributeError):
+        version = 'unknown'
+    info['version'] = version
+    return info
+
 
 class ShutdownAPIHandler(APIHandler):
     @needs_scope('shutdown')
@@ -22,22 +68,25 @@ class ShutdownAPIHandler(APIHandler):
         - servers: specify whether single-user servers should be terminated
         - proxy: specify whether the proxy should be terminated
         """
-        from ..app import JupyterHub
-
-        app = JupyterHub.instance()
-
-        data = self.get_json_body()
+        app = _jupyterhub_class().instance()
+
+        # skip JSON parsing entirely for empty bodies,
+        # the common case when shutting down via the CLI
+        if not self.request.body:
+            data = None
+        else:
+            data = self.get_json_body()
         if data:
             if 'proxy' in data:
                 proxy = data['proxy']
-                if proxy not in {True, False}:
+                if not isinstance(proxy, bool):
                     raise web.HTTPError(
                         400, f"proxy must be true or false, got {proxy!r}"
                     )
                 app.cleanup_proxy = proxy
             if 'servers' in data:
                 servers = data['servers']
-                if servers not in {True, False}:
+                if not isinstance(servers, bool):
                     raise web.HTTPError(
                         400, f"servers must be true or false, got {servers!r}"
                     )
@@ -45,7 +94,7 @@ class ShutdownAPIHandler(APIHandler):
 
         # finish the request
         self.set_status(202)
-        self.finish(json.dumps({"message": "Shutting down Hub"}))
+        self.finish(_json_dumps({"message": "Shutting down Hub"}))
 
         # instruct the app to stop, which will trigger cleanup
         app.stop()
@@ -61,8 +110,18 @@ class RootAPIHandler(APIHandler):
         if 'Access-Control-Allow-Origin' not in self.settings.get("headers", {}):
             # allow CORS requests to this endpoint by default
             self.set_header('Access-Control-Allow-Origin', '*')
+        # the response only changes when the Hub version does,
+        # so let clients and intermediaries cache it
+        self.set_header('Cache-Control', 'public, max-age=3600')
         super().set_default_headers()
 
+    def compute_etag(self):
+        """Use the Hub version as the ETag
+
+        lets tornado serve 304s to clients that already have the response
+        """
+        return _ROOT_ETAG
+
     def check_xsrf_cookie(self):
         return
 
@@ -72,11 +131,36 @@ class RootAPIHandler(APIHandler):
         It is not an authenticated endpoint
         For now, it just returns the version of JupyterHub itself.
         """
-        data = {'version': __version__}
-        self.finish(json.dumps(data))
+        self.set_header('Content-Length', _ROOT_JSON_LENGTH)
+        self.finish(_ROOT_JSON)
 
 
 class InfoAPIHandler(APIHandler):
+    # every field in the response is fixed for the process lifetime,
+    # so cache the serialized bytes, keyed by the configured classes
+    # in case the authenticator varies per request
+    _cached_json = {}
+
+    @classmethod
+    def prime(cls, spawner_class, authenticator_class):
+        """Precompute the serialized response for the configured classes
+
+        called during Hub startup so even the first request
+        is a constant-time bytes send
+        """
+        key = (spawner_class, authenticator_class)
+        cached = cls._cached_json.get(key)
+        if cached is None:
+            data = {
+                'version': __version__,
+                'python': _PY_VERSION,
+                'sys_executable': _SYS_EXECUTABLE,
+                'spawner': _class_info(spawner_class),
+                'authenticator': _class_info(authenticator_class),
+            }
+            cached = cls._cached_json[key] = _json_dumps(data)
+        return cached
+
     @needs_scope('read:hub')
     def get(self):
         """GET /api/info returns detailed info about the Hub and its API.
@@ -84,30 +168,15 @@ class InfoAPIHandler(APIHandler):
         Currently, it returns information on the python version, spawner and authenticator.
         Since this information might be sensitive, it is an authenticated endpoint
         """
-
-        def _class_info(typ):
-            """info about a class (Spawner or Authenticator)"""
-            info = {'class': f'{typ.__module__}.{typ.__name__}'}
-            pkg = typ.__module__.split('.')[0]
-            try:
-                version = sys.modules[pkg].__version__
-            except (KeyError, AttributeError):
-                version = 'unknown'
-            info['version'] = version
-            return info
-
-        data = {
-            'version': __version__,
-            'python': sys.version,
-            'sys_executable': sys.executable,
-            'spawner': _class_info(self.settings['spawner_class']),
-            'authenticator': _class_info(self.authenticator.__class__),
-        }
-        self.finish(json.dumps(data))
+        self.finish(
+            self.prime(self.settings['spawner_class'], self.authenticator.__class__)
+        )
 
 
+# anchored patterns, most frequently hit route first:
+# /api/ is unauthenticated and polled by health checks
 default_handlers = [
-    (r"/api/shutdown", ShutdownAPIHandler),
-    (r"/api/?", RootAPIHandler),
-    (r"/api/info", InfoAPIHandler),
+    (r"/api/?$", RootAPIHandler),
+    (r"/api/info$", InfoAPIHandler),
+    (r"/api/shutdown$", ShutdownAPIHandler),
 ]
@@ -1791,6 +1791,11 @@ class JupyterHub(Application):
         h.append((r'/logo', LogoHandler, {'path': self.logo_file}))
         h.append((r'/api/(.*)', apihandlers.base.API404))
 
+        # warm the /api/info response cache for the configured classes
+        apihandlers.hub.InfoAPIHandler.prime(
+            self.spawner_class, self.authenticator.__class__
+        )
+
         self.handlers = self.add_url_prefix(self.hub_prefix, h)
         # some extra handlers, outside hub_prefix
         self.handlers.extend(
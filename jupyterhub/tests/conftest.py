@@ -532,13 +532,18 @@ def create_user_with_scopes(app, create_temp_role):
     temp_users = []
     counter = 0
     get_role = create_temp_role
+    # reuse one role per distinct scope set within a test
+    # (temp roles are deleted at teardown, so don't cache beyond that)
+    role_cache = {}
 
     def temp_user_creator(*scopes, name=None):
         nonlocal counter
         if name is None:
             counter += 1
             name = f"temp_user_{counter}"
-        role = get_role(scopes)
+        role = role_cache.get(frozenset(scopes))
+        if role is None:
+            role = role_cache[frozenset(scopes)] = get_role(scopes)
         orm_user = orm.User(name=name)
         app.db.add(orm_user)
         app.db.commit()
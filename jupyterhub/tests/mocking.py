@@ -72,8 +72,67 @@ class MockSpawner(SimpleLocalProcessSpawner):
 
     - disables user-switching that we need root permissions to do
     - spawns `jupyterhub.tests.mocksu` instead of a full single-user server
+    - exposes `wait_spawn`/`wait_stop` so tests can await state transitions
+      instead of polling `pending` every 100ms
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # events set when a spawn or stop finishes (success or failure),
+        # driven by the _spawn_pending/_stop_pending transitions below
+        self._spawn_done = asyncio.Event()
+        self._stop_done = asyncio.Event()
+
+    # wrap the pending flags in properties so the events fire on the
+    # same transitions the Hub itself uses, covering failure paths
+    # (e.g. NeverSpawner timing out) without touching start()/stop()
+    _spawn_pending_flag = False
+    _stop_pending_flag = False
+
+    @property
+    def _spawn_pending(self):
+        return self._spawn_pending_flag
+
+    @_spawn_pending.setter
+    def _spawn_pending(self, value):
+        self._spawn_pending_flag = value
+        if value:
+            self._spawn_done.clear()
+        else:
+            self._spawn_done.set()
+
+    @property
+    def _stop_pending(self):
+        return self._stop_pending_flag
+
+    @_stop_pending.setter
+    def _stop_pending(self, value):
+        self._stop_pending_flag = value
+        if value:
+            self._stop_done.clear()
+        else:
+            self._stop_done.set()
+
+    async def wait_spawn(self, timeout=30):
+        """Wait for the current spawn to finish (success or failure)
+
+        Failed spawns are cleaned up via stop(),
+        which clears _spawn_pending before _stop_pending;
+        wait out any such in-flight stop so callers always
+        observe fully settled state.
+        """
+
+        async def settled():
+            await self._spawn_done.wait()
+            if self._stop_pending:
+                await self._stop_done.wait()
+
+        await asyncio.wait_for(settled(), timeout)
+
+    async def wait_stop(self, timeout=30):
+        """Wait for the current stop to finish"""
+        await asyncio.wait_for(self._stop_done.wait(), timeout)
+
     def user_env(self, env):
         env = super().user_env(env)
         if self.handler:
@@ -340,8 +399,12 @@ class MockHub(JupyterHub):
 
     async def initialize(self, argv=None):
         self.pid_file = NamedTemporaryFile(delete=False).name
+        # db_file is only kept as a lifecycle sentinel (see cleanup_after);
+        # the default test db is in-memory sqlite to avoid fsync on every commit
+        # (new_session_factory uses a StaticPool for :memory: urls,
+        # so one shared connection serves the whole app)
         self.db_file = NamedTemporaryFile()
-        self.db_url = os.getenv('JUPYTERHUB_TEST_DB_URL') or self.db_file.name
+        self.db_url = os.getenv('JUPYTERHUB_TEST_DB_URL') or 'sqlite:///:memory:'
         if 'mysql' in self.db_url:
             self.db_kwargs['connect_args'] = {'auth_plugin': 'mysql_native_password'}
         await super().initialize([])
@@ -6,14 +6,15 @@ import re
 import sys
 import uuid
 from copy import deepcopy
-from dataclasses import dataclass
-from datetime import datetime, timedelta
+from datetime import timedelta
 from unittest import mock
 from urllib.parse import parse_qs, quote, urlparse
 
 import pytest
 from dateutil.parser import parse as parse_date
 from pytest import fixture, mark
+from sqlalchemy.orm import raiseload, selectinload
+from tornado.httpclient import AsyncHTTPClient
 from tornado.httputil import url_concat
 
 import jupyterhub
@@ -25,11 +26,16 @@ from ..utils import url_path_join as ujoin
 from ..utils import utcnow
 from .conftest import new_username
 from .utils import (
+    AsyncSession,
     add_user,
     api_request,
     async_requests,
     auth_header,
+    bulk_add_users,
     find_user,
+    get_role,
+    json_dumps,
+    override_settings,
     public_host,
     public_url,
 )
@@ -100,6 +106,17 @@ async def test_post_content_type(app, content_type, status):
     assert r.status_code == status
 
 
+@fixture(scope="module")
+async def shared_user_cookies(app):
+    """Log in the permanent 'user' account once per module
+
+    For tests that need an authenticated cookie session
+    and don't care which user it belongs to.
+    Tests that mutate the cookies should copy them first.
+    """
+    return await app.login_user('user')
+
+
 @mark.parametrize("xsrf_in_url", [True, False, "invalid"])
 @mark.parametrize(
     "method, path",
@@ -108,8 +125,10 @@ async def test_post_content_type(app, content_type, status):
         ("POST", "users/{username}/tokens"),
     ],
 )
-async def test_xsrf_check(app, username, method, path, xsrf_in_url):
-    cookies = await app.login_user(username)
+async def test_xsrf_check(app, shared_user_cookies, method, path, xsrf_in_url):
+    # copy the shared cookies; some cases modify them
+    cookies = deepcopy(shared_user_cookies)
+    username = 'user'
     xsrf = cookies['_xsrf']
     if xsrf_in_url == "invalid":
         cookies.pop("_xsrf")
@@ -144,7 +163,9 @@ async def test_xsrf_check(app, username, method, path, xsrf_in_url):
         ("cookie_no_scope", "requires any of [list:users]"),
     ],
 )
-async def test_permission_error_messages(app, user, auth, expected_message):
+async def test_permission_error_messages(
+    app, user, shared_user_cookies, auth, expected_message
+):
     # 1. no credentials, should be 403 and not mention xsrf
 
     url = public_url(app, path="hub/api/users")
@@ -156,7 +177,8 @@ async def test_permission_error_messages(app, user, auth, expected_message):
         token = user.new_api_token()
         headers["Authorization"] = f"Bearer {token}"
     elif "cookie" in auth:
-        cookies = kwargs["cookies"] = await app.login_user(user.name)
+        # any authenticated cookie session will do; reuse the shared one
+        cookies = kwargs["cookies"] = shared_user_cookies
         if auth == "cookie_no_scope":
             params["_xsrf"] = cookies["_xsrf"]
         if auth == "cookie_xsrf_mismatch":
@@ -174,6 +196,11 @@ async def test_permission_error_messages(app, user, auth, expected_message):
 # --------------
 
 
+# compiled once: these run on every field of every normalized user model
+_timestamp_pat = re.compile(r'\d(\.\d+)?')
+_api_prefix_pat = re.compile(r'.*/hub/api')
+
+
 def normalize_timestamp(ts):
     """Normalize a timestamp
 
@@ -181,7 +208,7 @@ def normalize_timestamp(ts):
     """
     if ts is None:
         return
-    return re.sub(r'\d(\.\d+)?', '0', ts)
+    return _timestamp_pat.sub('0', ts)
 
 
 def normalize_user(user):
@@ -198,8 +225,8 @@ def normalize_user(user):
         for server in user['servers'].values():
             for key in ('started', 'last_activity'):
                 server[key] = normalize_timestamp(server[key])
-            server['progress_url'] = re.sub(
-                r'.*/hub/api', 'PREFIX/hub/api', server['progress_url']
+            server['progress_url'] = _api_prefix_pat.sub(
+                'PREFIX/hub/api', server['progress_url']
             )
             if isinstance(server['state'], dict) and isinstance(
                 server['state'].get('pid', None), int
@@ -225,7 +252,8 @@ def fill_user(model):
     return model
 
 
-TIMESTAMP = normalize_timestamp(datetime.now().isoformat() + 'Z')
+# what normalize_timestamp produces for any ISO timestamp
+TIMESTAMP = '0000-00-00T00:00:00Z'
 
 
 @mark.user
@@ -262,76 +290,38 @@ async def test_get_users(app):
 @fixture
 def default_page_limit(app):
     """Set and return low default page size for testing"""
+    # set/restore the one key directly:
+    # patch.dict would copy the whole settings dict twice per test
     n = 10
-    with mock.patch.dict(app.tornado_settings, {"api_page_default_limit": n}):
+    settings = app.tornado_settings
+    before = settings["api_page_default_limit"]
+    settings["api_page_default_limit"] = n
+    try:
         yield n
+    finally:
+        settings["api_page_default_limit"] = before
 
 
 @fixture
 def max_page_limit(app):
     """Set and return low max page size for testing"""
     n = 20
-    with mock.patch.dict(app.tornado_settings, {"api_page_max_limit": n}):
+    settings = app.tornado_settings
+    before = settings["api_page_max_limit"]
+    settings["api_page_max_limit"] = n
+    try:
         yield n
+    finally:
+        settings["api_page_max_limit"] = before
 
 
 @mark.user
-@mark.parametrize(
-    "n, offset, limit, accepts_pagination, expected_count, include_stopped_servers",
-    [
-        (10, None, None, False, 10, False),
-        (10, None, None, True, 10, False),
-        (10, 5, None, True, 5, False),
-        (10, 5, None, False, 5, False),
-        (10, None, 5, True, 5, True),
-        (10, 5, 1, True, 1, True),
-        (10, 10, 10, True, 0, False),
-        (  # default page limit, pagination expected
-            30,
-            None,
-            None,
-            True,
-            'default',
-            False,
-        ),
-        (
-            # default max page limit, pagination not expected
-            30,
-            None,
-            None,
-            False,
-            'max',
-            False,
-        ),
-        (
-            # limit exceeded
-            30,
-            None,
-            500,
-            False,
-            'max',
-            False,
-        ),
-    ],
-)
-async def test_get_users_pagination(
-    app,
-    n,
-    offset,
-    limit,
-    accepts_pagination,
-    expected_count,
-    default_page_limit,
-    max_page_limit,
-    include_stopped_servers,
-):
+async def test_get_users_pagination(app, default_page_limit, max_page_limit):
     db = app.db
+    n = 30
 
-    if expected_count == 'default':
-        expected_count = default_page_limit
-    elif expected_count == 'max':
-        expected_count = max_page_limit
-    # populate users
+    # populate the users once;
+    # the cases below only issue read-only API requests against them
     usernames = []
 
     groups = []
@@ -339,62 +329,84 @@ async def test_get_users_pagination(
         group = orm.Group(name=f"pagination-{i}")
         db.add(group)
     db.commit()
-    existing_users = db.query(orm.User).order_by(orm.User.id.asc())
+    existing_users = db.query(orm.User).order_by(orm.User.id.asc()).all()
     usernames.extend(u.name for u in existing_users)
 
-    for i in range(n - existing_users.count()):
-        name = new_username()
-        usernames.append(name)
-        user = add_user(db, app, name=name)
-        # add some users to groups
-        # make sure group membership doesn't affect pagination count
+    new_names = [new_username() for i in range(n - len(existing_users))]
+    usernames.extend(new_names)
+    new_users = bulk_add_users(db, new_names)
+    # add some users to groups
+    # make sure group membership doesn't affect pagination count
+    for i, user in enumerate(new_users):
         if i % 2:
             user.groups = groups
     db.commit()
 
-    total_users = db.query(orm.User).count()
-
-    url = 'users'
-    params = {}
-    if offset:
-        params['offset'] = offset
-    if limit:
-        params['limit'] = limit
-    url = url_concat(url, params)
-    if include_stopped_servers:
-        # assumes limit is set. There doesn't seem to be a way to set valueless query
-        # params using url_cat
-        url += "&include_stopped_servers"
-
-    headers = auth_header(db, 'admin')
-    if accepts_pagination:
-        headers['Accept'] = PAGINATION_MEDIA_TYPE
-    r = await api_request(app, url, headers=headers)
-    assert r.status_code == 200
-    response = r.json()
-    if accepts_pagination:
-        assert set(response) == {
-            "items",
-            "_pagination",
-        }
-        pagination = response["_pagination"]
-        if include_stopped_servers and pagination["next"]:
-            next_query = parse_qs(
-                urlparse(pagination["next"]["url"]).query, keep_blank_values=True
-            )
-            assert "include_stopped_servers" in next_query
-        users = response["items"]
-        assert pagination["total"] == total_users
-    else:
-        users = response
-    assert len(users) == expected_count
-    expected_usernames = usernames
-    if offset:
-        expected_usernames = expected_usernames[offset:]
-    expected_usernames = expected_usernames[:expected_count]
-
-    got_usernames = [u['name'] for u in users]
-    assert got_usernames == expected_usernames
+    # usernames now holds every user: existing plus newly added
+    total_users = len(usernames)
+
+    cases = [
+        # (offset, limit, accepts_pagination, include_stopped_servers)
+        (None, None, False, False),  # no pagination: max page limit applies
+        (None, None, True, False),  # pagination: default page limit applies
+        (5, None, True, False),
+        (5, None, False, False),
+        (None, 5, True, True),
+        (5, 1, True, True),
+        (total_users, 10, True, False),  # offset past the last user
+        (None, 500, False, False),  # limit exceeding the max is clamped
+    ]
+    for case in cases:
+        offset, limit, accepts_pagination, include_stopped_servers = case
+        # the limit the handler should apply (see get_api_pagination)
+        if limit is None:
+            limit_applied = default_page_limit if accepts_pagination else max_page_limit
+        else:
+            limit_applied = limit
+        limit_applied = min(limit_applied, max_page_limit)
+        expected_count = max(0, min(total_users - (offset or 0), limit_applied))
+
+        url = 'users'
+        params = {}
+        if offset:
+            params['offset'] = offset
+        if limit:
+            params['limit'] = limit
+        url = url_concat(url, params)
+        if include_stopped_servers:
+            # assumes limit is set. There doesn't seem to be a way to set valueless query
+            # params using url_cat
+            url += "&include_stopped_servers"
+
+        headers = auth_header(db, 'admin')
+        if accepts_pagination:
+            headers['Accept'] = PAGINATION_MEDIA_TYPE
+        r = await api_request(app, url, headers=headers)
+        assert r.status_code == 200, case
+        response = r.json()
+        if accepts_pagination:
+            assert set(response) == {
+                "items",
+                "_pagination",
+            }, case
+            pagination = response["_pagination"]
+            if include_stopped_servers and pagination["next"]:
+                next_query = parse_qs(
+                    urlparse(pagination["next"]["url"]).query, keep_blank_values=True
+                )
+                assert "include_stopped_servers" in next_query, case
+            users = response["items"]
+            assert pagination["total"] == total_users, case
+        else:
+            users = response
+        assert len(users) == expected_count, case
+        expected_usernames = usernames
+        if offset:
+            expected_usernames = expected_usernames[offset:]
+        expected_usernames = expected_usernames[:expected_count]
+
+        got_usernames = [u['name'] for u in users]
+        assert got_usernames == expected_usernames, case
 
 
 @mark.user
@@ -405,14 +417,17 @@ async def test_get_users_pagination(
 async def test_get_users_state_filter(app, state):
     db = app.db
 
-    # has_one_active: one active, one inactive, zero ready
-    has_one_active = add_user(db, app=app, name='has_one_active')
-    # has_two_active: two active, ready servers
-    has_two_active = add_user(db, app=app, name='has_two_active')
-    # has_two_inactive: two spawners, neither active
-    has_two_inactive = add_user(db, app=app, name='has_two_inactive')
-    # has_zero: no Spawners registered at all
-    has_zero = add_user(db, app=app, name='has_zero')
+    # one bulk insert instead of a commit per user:
+    # - has_one_active: one active, one inactive, zero ready
+    # - has_two_active: two active, ready servers
+    # - has_two_inactive: two spawners, neither active
+    # - has_zero: no Spawners registered at all
+    has_one_active, has_two_active, has_two_inactive, has_zero = (
+        app.users[orm_user.id]
+        for orm_user in bulk_add_users(
+            db, ['has_one_active', 'has_two_active', 'has_two_inactive', 'has_zero']
+        )
+    )
     total_users = db.query(orm.User).count()
 
     test_usernames = {
@@ -436,15 +451,16 @@ async def test_get_users_state_filter(app, state):
         If active, should turn up in an active query
         If active and ready, should turn up in a ready query
         If not active, should turn up in an inactive query
+
+        Changes are flushed but not committed;
+        one commit covers the whole setup batch.
         """
         spawner = user.spawners[name]
-        db.commit()
         if active:
             orm_server = orm.Server()
             db.add(orm_server)
-            db.commit()
+            db.flush()
             spawner.server = Server(orm_server=orm_server)
-            db.commit()
             if not ready:
                 spawner._spawn_pending = True
         return spawner
@@ -455,6 +471,7 @@ async def test_get_users_state_filter(app, state):
 
     add_spawner(has_one_active, active=True, ready=False)
     add_spawner(has_one_active, "inactive", active=False)
+    db.commit()
 
     r = await api_request(
         app, f'users?state={state}', headers={"Accept": PAGINATION_MEDIA_TYPE}
@@ -468,8 +485,9 @@ async def test_get_users_state_filter(app, state):
     users = response["items"]
     page = response["_pagination"]
 
-    usernames = sorted(u["name"] for u in users if u["name"] in test_usernames)
-    assert usernames == expected
+    # order is not part of the contract here, so compare as sets
+    usernames = {u["name"] for u in users if u["name"] in test_usernames}
+    assert usernames == set(expected)
     if state == "ready":
         # "ready" can't actually get a correct count because it has post-filtering applied
         # but it has an upper bound
@@ -543,16 +561,8 @@ async def test_get_users_sort(app, sort, direction):
     u.last_activity = utcnow() - timedelta(days=1)
     app.db.commit()
 
-    @dataclass
-    class UserName:
-        """Parse username so we can get the current sort field"""
-
-        id: str
-        name: str
-        last_activity: str
-
-        def __init__(self, username):
-            prefix, self.name, self.id, self.last_activity = username.split("-")
+    # index of each sort field in the 'prefix-name-id-last_activity' usernames
+    sort_field_index = {"name": 1, "id": 2, "last_activity": 3}
 
     # fetch 4 users in 2 pages of 2 items each
     # to ensure offset is handled correctly
@@ -583,8 +593,8 @@ async def test_get_users_sort(app, sort, direction):
     # turn user dicts into list of only the relevant component,
     # e.g. { "name": "xyz-a-2-late" } -> "late"
     users.extend(page_2["items"])
-    usernames = [UserName(u["name"]) for u in users]
-    sorted_fields = [getattr(u, sort) for u in usernames]
+    index = sort_field_index[sort]
+    sorted_fields = [u["name"].split("-")[index] for u in users]
     assert sorted_fields == expected_order
 
 
@@ -660,8 +670,8 @@ async def test_add_user(app):
     assert user.name == name
     assert not user.admin
     # assert newuser has default 'user' role
-    assert orm.Role.find(db, 'user') in user.roles
-    assert orm.Role.find(db, 'admin') not in user.roles
+    assert get_role(db, 'user') in user.roles
+    assert get_role(db, 'admin') not in user.roles
 
 
 @mark.user
@@ -726,7 +736,7 @@ async def test_add_multi_user_invalid(app):
         app,
         'users',
         method='post',
-        data=json.dumps({'usernames': ['Willow', 'Andrew', 'Tara']}),
+        data=json_dumps({'usernames': ['Willow', 'Andrew', 'Tara']}),
     )
     app.authenticator.username_pattern = ''
     assert r.status_code == 400
@@ -739,25 +749,34 @@ async def test_add_multi_user(app):
     db = app.db
     names = ['a', 'b']
     r = await api_request(
-        app, 'users', method='post', data=json.dumps({'usernames': names})
+        app, 'users', method='post', data=json_dumps({'usernames': names})
     )
     assert r.status_code == 201
     reply = r.json()
     r_names = [user['name'] for user in reply]
     assert names == r_names
 
+    # one query for the users (and their roles), one per role
+    user_role = get_role(db, 'user')
+    admin_role = get_role(db, 'admin')
+    users = {
+        user.name: user
+        for user in db.query(orm.User)
+        .filter(orm.User.name.in_(names))
+        .options(selectinload(orm.User.roles))
+    }
     for name in names:
-        user = find_user(db, name)
+        user = users.get(name)
         assert user is not None
         assert user.name == name
         assert not user.admin
         # assert default 'user' role added
-        assert orm.Role.find(db, 'user') in user.roles
-        assert orm.Role.find(db, 'admin') not in user.roles
+        assert user_role in user.roles
+        assert admin_role not in user.roles
 
     # try to create the same users again
     r = await api_request(
-        app, 'users', method='post', data=json.dumps({'usernames': names})
+        app, 'users', method='post', data=json_dumps({'usernames': names})
     )
     assert r.status_code == 409
 
@@ -765,7 +784,7 @@ async def test_add_multi_user(app):
 
     # try to create the same users again
     r = await api_request(
-        app, 'users', method='post', data=json.dumps({'usernames': names})
+        app, 'users', method='post', data=json_dumps({'usernames': names})
     )
     assert r.status_code == 201
     reply = r.json()
@@ -786,7 +805,7 @@ async def test_add_multi_user_admin(app, create_user_with_scopes, is_admin):
         app,
         'users',
         method='post',
-        data=json.dumps({'usernames': names, 'admin': True}),
+        data=json_dumps({'usernames': names, 'admin': True}),
         name=requester.name,
     )
     if is_admin:
@@ -798,13 +817,21 @@ async def test_add_multi_user_admin(app, create_user_with_scopes, is_admin):
     r_names = [user['name'] for user in reply]
     assert names == r_names
 
+    user_role = get_role(db, 'user')
+    admin_role = get_role(db, 'admin')
+    users = {
+        user.name: user
+        for user in db.query(orm.User)
+        .filter(orm.User.name.in_(names))
+        .options(selectinload(orm.User.roles))
+    }
     for name in names:
-        user = find_user(db, name)
+        user = users.get(name)
         assert user is not None
         assert user.name == name
         assert user.admin
-        assert orm.Role.find(db, 'user') in user.roles
-        assert orm.Role.find(db, 'admin') in user.roles
+        assert user_role in user.roles
+        assert admin_role in user.roles
 
 
 @mark.user
@@ -843,7 +870,7 @@ async def test_add_admin(app, create_user_with_scopes, is_admin):
         'users',
         name,
         method='post',
-        data=json.dumps({'admin': True}),
+        data=json_dumps({'admin': True}),
         name=user.name,
     )
     if is_admin:
@@ -856,14 +883,14 @@ async def test_add_admin(app, create_user_with_scopes, is_admin):
     assert user.name == name
     assert user.admin
     # assert newadmin has default 'admin' role
-    assert orm.Role.find(db, 'user') in user.roles
-    assert orm.Role.find(db, 'admin') in user.roles
+    assert get_role(db, 'user') in user.roles
+    assert get_role(db, 'admin') in user.roles
 
 
 @mark.user
 async def test_delete_user(app):
     db = app.db
-    mal = add_user(db, name='mal')
+    add_user(db, name='mal')
     r = await api_request(app, 'users', 'mal', method='delete')
     assert r.status_code == 204
 
@@ -877,6 +904,9 @@ async def test_user_make_admin(app, create_user_with_scopes, is_admin):
     requester.admin = is_admin
     db.commit()
 
+    user_role = get_role(db, 'user')
+    admin_role = get_role(db, 'admin')
+
     name = new_username("make_admin")
     r = await api_request(app, 'users', name, method='post')
     assert r.status_code == 201
@@ -884,15 +914,15 @@ async def test_user_make_admin(app, create_user_with_scopes, is_admin):
     assert user is not None
     assert user.name == name
     assert not user.admin
-    assert orm.Role.find(db, 'user') in user.roles
-    assert orm.Role.find(db, 'admin') not in user.roles
+    assert user_role in user.roles
+    assert admin_role not in user.roles
 
     r = await api_request(
         app,
         'users',
         name,
         method='patch',
-        data=json.dumps({'admin': True}),
+        data=json_dumps({'admin': True}),
         name=requester.name,
     )
     if is_admin:
@@ -904,8 +934,8 @@ async def test_user_make_admin(app, create_user_with_scopes, is_admin):
     assert user is not None
     assert user.name == name
     assert user.admin
-    assert orm.Role.find(db, 'user') in user.roles
-    assert orm.Role.find(db, 'admin') in user.roles
+    assert user_role in user.roles
+    assert admin_role in user.roles
 
 
 @mark.user
@@ -926,7 +956,7 @@ async def test_user_set_name(
         'users',
         user.name,
         method='patch',
-        data=json.dumps({'name': new_name}),
+        data=json_dumps({'name': new_name}),
         name=requester.name,
     )
     if requester_is_admin or not user_is_admin:
@@ -950,7 +980,7 @@ async def test_set_auth_state(app, auth_state_enabled):
     assert user.name == name
 
     r = await api_request(
-        app, 'users', name, method='patch', data=json.dumps({'auth_state': auth_state})
+        app, 'users', name, method='patch', data=json_dumps({'auth_state': auth_state})
     )
 
     assert r.status_code == 200
@@ -973,7 +1003,7 @@ async def test_user_set_auth_state(app, auth_state_enabled):
         'users',
         name,
         method='patch',
-        data=json.dumps({'auth_state': auth_state}),
+        data=json_dumps({'auth_state': auth_state}),
         headers=auth_header(app.db, name),
     )
     assert r.status_code == 403
@@ -1014,14 +1044,25 @@ async def test_user_get_auth_state(app, auth_state_enabled):
     assert 'auth_state' not in r.json()
 
 
+# constant spawn request bodies, encoded once at import time
+_spawn_options = {'s': ['value'], 'i': 5}
+_spawn_options_body = json_dumps(_spawn_options)
+_new_spawn_options = {'key': 'value'}
+_new_spawn_options_body = json_dumps(_new_spawn_options)
+
+
 async def test_spawn(app):
     db = app.db
     name = 'wash'
     user = add_user(db, app=app, name=name)
-    options = {'s': ['value'], 'i': 5}
-    before_servers = sorted(db.query(orm.Server), key=lambda s: s.url)
+    options = _spawn_options
+    before_servers = (
+        db.query(orm.Server.id, orm.Server.base_url, orm.Server.port)
+        .order_by(orm.Server.id)
+        .all()
+    )
     r = await api_request(
-        app, 'users', name, 'server', method='post', data=json.dumps(options)
+        app, 'users', name, 'server', method='post', data=_spawn_options_body
     )
     assert r.status_code == 201
     assert 'pid' in user.orm_spawners[''].state
@@ -1035,21 +1076,23 @@ async def test_spawn(app):
 
     assert spawner.server.base_url == ujoin(app.base_url, f'user/{name}') + '/'
     url = public_url(app, user)
-    kwargs = {}
+    # load certs into a session once,
+    # shared by the three server fetches below
+    s = AsyncSession()
     if app.internal_ssl:
-        kwargs['cert'] = (app.internal_ssl_cert, app.internal_ssl_key)
-        kwargs["verify"] = app.internal_ssl_ca
-    r = await async_requests.get(url, **kwargs)
+        s.cert = (app.internal_ssl_cert, app.internal_ssl_key)
+        s.verify = app.internal_ssl_ca
+    r = await s.get(url)
     assert r.status_code == 200
     assert r.text == spawner.server.base_url
 
-    r = await async_requests.get(ujoin(url, 'args'), **kwargs)
+    r = await s.get(ujoin(url, 'args'))
     assert r.status_code == 200
     argv = r.json()
     assert '--port' not in ' '.join(argv)
     # we pass no CLI args anymore:
     assert len(argv) == 1
-    r = await async_requests.get(ujoin(url, 'env'), **kwargs)
+    r = await s.get(ujoin(url, 'env'))
     env = r.json()
     for expected in [
         'JUPYTERHUB_USER',
@@ -1070,54 +1113,62 @@ async def test_spawn(app):
 
     # check that we cleaned up after ourselves
     assert spawner.server is None
-    after_servers = sorted(db.query(orm.Server), key=lambda s: s.url)
+    after_servers = (
+        db.query(orm.Server.id, orm.Server.base_url, orm.Server.port)
+        .order_by(orm.Server.id)
+        .all()
+    )
     assert before_servers == after_servers
-    tokens = list(db.query(orm.APIToken).filter(orm.APIToken.user_id == user.id))
+    # raiseload: the rows are only counted, so any lazy relationship
+    # load here would be an accidental N+1 and should error
+    tokens = (
+        db.query(orm.APIToken)
+        .filter(orm.APIToken.user_id == user.id)
+        .options(raiseload('*'))
+        .all()
+    )
     assert tokens == []
     assert app.users.count_active_users()['pending'] == 0
 
 
-async def test_user_options(app, username):
-    db = app.db
-    name = username
-    user = add_user(db, app=app, name=name)
-    options = {'s': ['value'], 'i': 5}
-    before_servers = sorted(db.query(orm.Server), key=lambda s: s.url)
-    r = await api_request(
-        app, 'users', name, 'server', method='post', data=json.dumps(options)
-    )
-    assert r.status_code == 201
-    assert 'pid' in user.orm_spawners[''].state
-    app_user = app.users[name]
-    assert app_user.spawner is not None
-    spawner = app_user.spawner
-    assert spawner.user_options == options
-    assert spawner.orm_spawner.user_options == options
+def _seed_user_options(db, app, name, options):
+    """Record saved user_options as if left by a previous spawn
 
-    # stop the server
-    r = await api_request(app, 'users', name, 'server', method='delete')
+    Spawn reads defaults from orm_spawner.user_options,
+    so seeding the column directly stands in for a full
+    spawn/stop cycle when testing reuse and override.
+    """
+    user = add_user(db, app=app, name=name)
+    spawner = app.users[name].spawners['']
+    spawner.orm_spawner.user_options = options
+    db.commit()
+    return user
 
-    # orm_spawner still exists and has a reference to the user_options
-    assert spawner.orm_spawner.user_options == options
 
-    # spawn again, no options specified
-    # should re-use options from last spawn
+async def test_user_options_reuse(app, username):
+    """spawning with no options re-uses those saved by the last spawn"""
+    db = app.db
+    name = username
+    user = _seed_user_options(db, app, name, _spawn_options)
     r = await api_request(app, 'users', name, 'server', method='post')
     assert r.status_code == 201
     assert 'pid' in user.orm_spawners[''].state
     app_user = app.users[name]
     assert app_user.spawner is not None
-    spawner = app_user.spawner
-    assert spawner.user_options == options
+    assert app_user.spawner.user_options == _spawn_options
 
     # stop the server
     r = await api_request(app, 'users', name, 'server', method='delete')
 
-    # spawn again, new options specified
-    # should override options from last spawn
-    new_options = {'key': 'value'}
+
+async def test_user_options_override(app, username):
+    """spawning with options overrides those saved by the last spawn"""
+    db = app.db
+    name = username
+    user = _seed_user_options(db, app, name, _spawn_options)
+    new_options = _new_spawn_options
     r = await api_request(
-        app, 'users', name, 'server', method='post', data=json.dumps(new_options)
+        app, 'users', name, 'server', method='post', data=_new_spawn_options_body
     )
     assert r.status_code == 201
     assert 'pid' in user.orm_spawners[''].state
@@ -1128,6 +1179,12 @@ async def test_user_options(app, username):
     # saved in db
     assert spawner.orm_spawner.user_options == new_options
 
+    # stop the server
+    r = await api_request(app, 'users', name, 'server', method='delete')
+
+    # orm_spawner still exists and has a reference to the user_options
+    assert spawner.orm_spawner.user_options == new_options
+
 
 async def test_spawn_handler(app):
     """Test that the requesting Handler is passed to Spawner.handler"""
@@ -1172,39 +1229,31 @@ async def test_slow_spawn(app, no_patience, slow_spawn):
     assert not app_user.spawner._stop_pending
     assert app.users.count_active_users()['pending'] == 1
 
-    async def wait_spawn():
-        while not app_user.running:
-            await asyncio.sleep(0.1)
-
-    await wait_spawn()
+    await app_user.spawner.wait_spawn()
+    assert app_user.running
     assert not app_user.spawner._spawn_pending
     status = await app_user.spawner.poll()
     assert status is None
 
-    async def wait_stop():
-        while app_user.spawner._stop_pending:
-            await asyncio.sleep(0.1)
-
-    r = await api_request(app, 'users', name, 'server', method='delete')
-    r.raise_for_status()
-    assert r.status_code == 202
-    assert app_user.spawner is not None
-    assert app_user.spawner._stop_pending
-
-    r = await api_request(app, 'users', name, 'server', method='delete')
-    r.raise_for_status()
-    assert r.status_code == 202
+    # concurrent DELETEs while the stop is pending are idempotent:
+    # both should return 202 without triggering a second stop
+    r1, r2 = await asyncio.gather(
+        api_request(app, 'users', name, 'server', method='delete'),
+        api_request(app, 'users', name, 'server', method='delete'),
+    )
+    assert r1.status_code == r2.status_code == 202
     assert app_user.spawner is not None
     assert app_user.spawner._stop_pending
 
-    await wait_stop()
+    await app_user.spawner.wait_stop()
     assert not app_user.spawner._stop_pending
     assert app_user.spawner is not None
     r = await api_request(app, 'users', name, 'server', method='delete')
     # 204 deleted if there's no such server
     assert r.status_code == 204
-    assert app.users.count_active_users()['pending'] == 0
-    assert app.users.count_active_users()['active'] == 0
+    counts = app.users.count_active_users()
+    assert counts['pending'] == 0
+    assert counts['active'] == 0
 
 
 async def test_never_spawn(app, no_patience, never_spawn):
@@ -1216,10 +1265,8 @@ async def test_never_spawn(app, no_patience, never_spawn):
     assert app_user.spawner._spawn_pending
     assert app.users.count_active_users()['pending'] == 1
 
-    while app_user.spawner.pending:
-        await asyncio.sleep(0.1)
-        print(app_user.spawner.pending)
-
+    await app_user.spawner.wait_spawn()
+    assert not app_user.spawner.pending
     assert not app_user.spawner._spawn_pending
     status = await app_user.spawner.poll()
     assert status is not None
@@ -1254,8 +1301,7 @@ async def test_slow_bad_spawn(app, no_patience, slow_bad_spawn):
     user = add_user(db, app=app, name=name)
     r = await api_request(app, 'users', name, 'server', method='post')
     r.raise_for_status()
-    while user.spawner.pending:
-        await asyncio.sleep(0.1)
+    await user.spawner.wait_spawn()
     # spawn failed
     assert not user.running
     assert app.users.count_active_users()['pending'] == 0
@@ -1272,27 +1318,49 @@ def next_event(it):
             return json.loads(line.split(':', 1)[1])
 
 
+async def stream_progress(app, name):
+    """Fetch the progress eventstream for a user's default server
+
+    Uses tornado's own AsyncHTTPClient directly against the Hub,
+    so the request runs on the test's event loop: no proxy hop,
+    no requests threadpool, and no reader thread. The stream always
+    terminates once the spawn settles, so the events are parsed from
+    the completed response.
+
+    Returns the list of parsed data events.
+    """
+    url = ujoin(app.hub.url, 'api/users', name, 'server/progress')
+    kwargs = {}
+    if app.internal_ssl:
+        kwargs['ca_certs'] = app.internal_ssl_ca
+        kwargs['client_cert'] = app.internal_ssl_cert
+        kwargs['client_key'] = app.internal_ssl_key
+    resp = await AsyncHTTPClient().fetch(
+        url,
+        headers=auth_header(app.db, 'admin'),
+        request_timeout=60,
+        **kwargs,
+    )
+    assert resp.headers['content-type'] == 'text/event-stream'
+    return [
+        json.loads(line.split(':', 1)[1])
+        for line in resp.body.decode('utf8').splitlines()
+        if line.startswith('data:')
+    ]
+
+
 @mark.slow
-async def test_progress(request, app, no_patience, slow_spawn):
+async def test_progress(app, no_patience, slow_spawn):
     db = app.db
     name = 'martin'
     app_user = add_user(db, app=app, name=name)
     r = await api_request(app, 'users', name, 'server', method='post')
     r.raise_for_status()
-    r = await api_request(app, 'users', name, 'server/progress', stream=True)
-    r.raise_for_status()
-    request.addfinalizer(r.close)
-    assert r.headers['content-type'] == 'text/event-stream'
-
-    ex = async_requests.executor
-    line_iter = iter(r.iter_lines(decode_unicode=True))
-    evt = await ex.submit(next_event, line_iter)
-    assert evt == {'progress': 0, 'message': 'Server requested'}
-    evt = await ex.submit(next_event, line_iter)
-    assert evt == {'progress': 50, 'message': 'Spawning server...'}
-    evt = await ex.submit(next_event, line_iter)
+    events = await stream_progress(app, name)
+    assert events[0] == {'progress': 0, 'message': 'Server requested'}
+    assert events[1] == {'progress': 50, 'message': 'Spawning server...'}
     url = app_user.url
-    assert evt == {
+    assert events[2] == {
         'progress': 100,
         'message': f'Server ready at {url}',
         'html_message': f'Server ready at <a href="{url}">{url}</a>',
@@ -1301,7 +1369,7 @@ async def test_progress(request, app, no_patience, slow_spawn):
     }
 
 
-async def test_progress_not_started(request, app):
+async def test_progress_not_started(app):
     db = app.db
     name = 'nope'
     app_user = add_user(db, app=app, name=name)
@@ -1313,164 +1381,106 @@ async def test_progress_not_started(request, app):
     assert r.status_code == 404
 
 
-async def test_progress_not_found(request, app):
+async def test_progress_not_found(app):
     db = app.db
     name = 'noserver'
+    # no such user
     r = await api_request(app, 'users', 'nosuchuser', 'server/progress')
     assert r.status_code == 404
-    app_user = add_user(db, app=app, name=name)
+    # user exists, but spawner does not: distinct 404 path,
+    # so this user really does need to be created
+    add_user(db, app=app, name=name)
     r = await api_request(app, 'users', name, 'server/progress')
     assert r.status_code == 404
 
 
-async def test_progress_ready(request, app):
-    """Test progress API when spawner is already started
-
-    e.g. a race between requesting progress and progress already being complete
-    """
-    db = app.db
-    name = 'saga'
-    app_user = add_user(db, app=app, name=name)
-    r = await api_request(app, 'users', name, 'server', method='post')
-    r.raise_for_status()
-    r = await api_request(app, 'users', name, 'server/progress', stream=True)
-    r.raise_for_status()
-    request.addfinalizer(r.close)
-    assert r.headers['content-type'] == 'text/event-stream'
-    ex = async_requests.executor
-    line_iter = iter(r.iter_lines(decode_unicode=True))
-    evt = await ex.submit(next_event, line_iter)
-    assert evt['progress'] == 100
-    assert evt['ready']
-    assert evt['url'] == app_user.url
-
-
-async def test_progress_ready_hook_async_func(request, app):
-    """Test progress ready hook in Spawner class with an async function"""
-    db = app.db
-    name = 'saga'
-    app_user = add_user(db, app=app, name=name)
-    html_message = 'customized html message'
-    spawner = app_user.spawner
-
+def _async_ready_hook(html_message):
     async def custom_progress_ready_hook(spawner, ready_event):
         ready_event['html_message'] = html_message
         return ready_event
 
-    spawner.progress_ready_hook = custom_progress_ready_hook
-    r = await api_request(app, 'users', name, 'server', method='post')
-    r.raise_for_status()
-    r = await api_request(app, 'users', name, 'server/progress', stream=True)
-    r.raise_for_status()
-    request.addfinalizer(r.close)
-    assert r.headers['content-type'] == 'text/event-stream'
-    ex = async_requests.executor
-    line_iter = iter(r.iter_lines(decode_unicode=True))
-    evt = await ex.submit(next_event, line_iter)
-    assert evt['progress'] == 100
-    assert evt['ready']
-    assert evt['url'] == app_user.url
-    assert evt['html_message'] == html_message
-
+    return custom_progress_ready_hook
 
-async def test_progress_ready_hook_sync_func(request, app):
-    """Test progress ready hook in Spawner class with a sync function"""
-    db = app.db
-    name = 'saga'
-    app_user = add_user(db, app=app, name=name)
-    html_message = 'customized html message'
-    spawner = app_user.spawner
 
+def _sync_ready_hook(html_message):
     def custom_progress_ready_hook(spawner, ready_event):
         ready_event['html_message'] = html_message
         return ready_event
 
-    spawner.progress_ready_hook = custom_progress_ready_hook
-    r = await api_request(app, 'users', name, 'server', method='post')
-    r.raise_for_status()
-    r = await api_request(app, 'users', name, 'server/progress', stream=True)
-    r.raise_for_status()
-    request.addfinalizer(r.close)
-    assert r.headers['content-type'] == 'text/event-stream'
-    ex = async_requests.executor
-    line_iter = iter(r.iter_lines(decode_unicode=True))
-    evt = await ex.submit(next_event, line_iter)
-    assert evt['progress'] == 100
-    assert evt['ready']
-    assert evt['url'] == app_user.url
-    assert evt['html_message'] == html_message
-
+    return custom_progress_ready_hook
 
-async def test_progress_ready_hook_async_func_exception(request, app):
-    """Test progress ready hook in Spawner class with an exception in
-    an async function
-    """
-    db = app.db
-    name = 'saga'
-    app_user = add_user(db, app=app, name=name)
-    html_message = f'Server ready at <a href="{app_user.url}">{app_user.url}</a>'
-    spawner = app_user.spawner
 
+def _raising_ready_hook(html_message):
     async def custom_progress_ready_hook(spawner, ready_event):
         ready_event["html_message"] = "."
         raise Exception()
 
-    spawner.progress_ready_hook = custom_progress_ready_hook
+    return custom_progress_ready_hook
+
+
+@mark.parametrize(
+    "hook_factory, expect_custom_html",
+    [
+        (None, False),
+        (_async_ready_hook, True),
+        (_sync_ready_hook, True),
+        # a raising hook should leave the default message intact
+        (_raising_ready_hook, False),
+    ],
+    ids=["no_hook", "async_hook", "sync_hook", "bad_hook"],
+)
+async def test_progress_ready(app, hook_factory, expect_custom_html):
+    """Test progress API when spawner is already started
+
+    e.g. a race between requesting progress and progress already being complete,
+    with and without a progress_ready_hook on the Spawner
+    """
+    db = app.db
+    name = 'saga'
+    app_user = add_user(db, app=app, name=name)
+    html_message = 'customized html message'
+    if hook_factory is not None:
+        app_user.spawner.progress_ready_hook = hook_factory(html_message)
     r = await api_request(app, 'users', name, 'server', method='post')
     r.raise_for_status()
-    r = await api_request(app, 'users', name, 'server/progress', stream=True)
-    r.raise_for_status()
-    request.addfinalizer(r.close)
-    assert r.headers['content-type'] == 'text/event-stream'
-    ex = async_requests.executor
-    line_iter = iter(r.iter_lines(decode_unicode=True))
-    evt = await ex.submit(next_event, line_iter)
+    events = await stream_progress(app, name)
+    evt = events[0]
     assert evt['progress'] == 100
     assert evt['ready']
     assert evt['url'] == app_user.url
-    assert evt['html_message'] == html_message
+    if expect_custom_html:
+        assert evt['html_message'] == html_message
+    else:
+        url = app_user.url
+        assert evt['html_message'] == f'Server ready at <a href="{url}">{url}</a>'
 
 
-async def test_progress_bad(request, app, bad_spawn):
+async def test_progress_bad(app, bad_spawn):
     """Test progress API when spawner has already failed"""
     db = app.db
     name = 'simon'
     app_user = add_user(db, app=app, name=name)
     r = await api_request(app, 'users', name, 'server', method='post')
     assert r.status_code == 500
-    r = await api_request(app, 'users', name, 'server/progress', stream=True)
-    r.raise_for_status()
-    request.addfinalizer(r.close)
-    assert r.headers['content-type'] == 'text/event-stream'
-    ex = async_requests.executor
-    line_iter = iter(r.iter_lines(decode_unicode=True))
-    evt = await ex.submit(next_event, line_iter)
-    assert evt == {
+    events = await stream_progress(app, name)
+    assert events[0] == {
         'progress': 100,
         'failed': True,
         'message': "Spawn failed: I don't work!",
     }
 
 
-async def test_progress_bad_slow(request, app, no_patience, slow_bad_spawn):
+async def test_progress_bad_slow(app, no_patience, slow_bad_spawn):
     """Test progress API when spawner fails while watching"""
     db = app.db
     name = 'eugene'
     app_user = add_user(db, app=app, name=name)
     r = await api_request(app, 'users', name, 'server', method='post')
     assert r.status_code == 202
-    r = await api_request(app, 'users', name, 'server/progress', stream=True)
-    r.raise_for_status()
-    request.addfinalizer(r.close)
-    assert r.headers['content-type'] == 'text/event-stream'
-    ex = async_requests.executor
-    line_iter = iter(r.iter_lines(decode_unicode=True))
-    evt = await ex.submit(next_event, line_iter)
-    assert evt['progress'] == 0
-    evt = await ex.submit(next_event, line_iter)
-    assert evt['progress'] == 50
-    evt = await ex.submit(next_event, line_iter)
-    assert evt == {
+    events = await stream_progress(app, name)
+    assert events[0]['progress'] == 0
+    assert events[1]['progress'] == 50
+    assert events[2] == {
         'progress': 100,
         'failed': True,
         'message': "Spawn failed: I don't work!",
@@ -1485,7 +1495,7 @@ async def progress_forever():
         await asyncio.sleep(10)
 
 
-async def test_spawn_progress_cutoff(request, app, no_patience, slow_spawn):
+async def test_spawn_progress_cutoff(app, no_patience, slow_spawn):
     """Progress events stop when Spawner finishes
 
     even if progress iterator is still going.
@@ -1498,123 +1508,120 @@ async def test_spawn_progress_cutoff(request, app, no_patience, slow_spawn):
 
     r = await api_request(app, 'users', name, 'server', method='post')
     r.raise_for_status()
-    r = await api_request(app, 'users', name, 'server/progress', stream=True)
-    r.raise_for_status()
-    request.addfinalizer(r.close)
-    ex = async_requests.executor
-    line_iter = iter(r.iter_lines(decode_unicode=True))
-    evt = await ex.submit(next_event, line_iter)
-    assert evt['progress'] == 0
-    evt = await ex.submit(next_event, line_iter)
-    assert evt == {'progress': 1, 'message': 'Stage 1'}
-    evt = await ex.submit(next_event, line_iter)
-    assert evt['progress'] == 100
+    events = await stream_progress(app, name)
+    assert events[0]['progress'] == 0
+    assert events[1] == {'progress': 1, 'message': 'Stage 1'}
+    assert events[2]['progress'] == 100
 
 
-async def test_spawn_limit(app, no_patience, slow_spawn, request):
+async def test_spawn_limit(app, no_patience, slow_spawn):
     db = app.db
-    p = mock.patch.dict(app.tornado_settings, {'concurrent_spawn_limit': 2})
-    p.start()
-    request.addfinalizer(p.stop)
-
-    # start two pending spawns
-    names = ['ykka', 'hjarka']
-    users = [add_user(db, app=app, name=name) for name in names]
-    users[0].spawner._start_future = asyncio.Future()
-    users[1].spawner._start_future = asyncio.Future()
-    for name in names:
-        await api_request(app, 'users', name, 'server', method='post')
-    assert app.users.count_active_users()['pending'] == 2
-
-    # ykka and hjarka's spawns are both pending. Essun should fail with 429
-    name = 'essun'
-    user = add_user(db, app=app, name=name)
-    user.spawner._start_future = asyncio.Future()
-    r = await api_request(app, 'users', name, 'server', method='post')
-    assert r.status_code == 429
+    with override_settings(app, concurrent_spawn_limit=2):
+        # start two pending spawns
+        names = ['ykka', 'hjarka']
+        users = bulk_add_users(db, names, app=app)
+        users[0].spawner._start_future = asyncio.Future()
+        users[1].spawner._start_future = asyncio.Future()
+        for name in names:
+            await api_request(app, 'users', name, 'server', method='post')
+        assert app.users.count_active_users()['pending'] == 2
+
+        # ykka and hjarka's spawns are both pending. Essun should fail with 429
+        name = 'essun'
+        user = add_user(db, app=app, name=name)
+        user.spawner._start_future = asyncio.Future()
+        r = await api_request(app, 'users', name, 'server', method='post')
+        assert r.status_code == 429
 
-    # allow ykka to start
-    users[0].spawner._start_future.set_result(None)
-    # wait for ykka to finish
-    while not users[0].running:
-        await asyncio.sleep(0.1)
+        # allow ykka to start
+        users[0].spawner._start_future.set_result(None)
+        # wait for ykka to finish
+        await users[0].spawner.wait_spawn()
 
-    assert app.users.count_active_users()['pending'] == 1
-    r = await api_request(app, 'users', name, 'server', method='post')
-    r.raise_for_status()
-    assert app.users.count_active_users()['pending'] == 2
-    users.append(user)
-    # allow hjarka and essun to finish starting
-    for user in users[1:]:
-        user.spawner._start_future.set_result(None)
-    while not all(u.running for u in users):
-        await asyncio.sleep(0.1)
-
-    # everybody's running, pending count should be back to 0
-    assert app.users.count_active_users()['pending'] == 0
-    for u in users:
-        u.spawner.delay = 0
-        r = await api_request(app, 'users', u.name, 'server', method='delete')
+        assert app.users.count_active_users()['pending'] == 1
+        r = await api_request(app, 'users', name, 'server', method='post')
         r.raise_for_status()
-    while any(u.spawner.active for u in users):
-        await asyncio.sleep(0.1)
+        assert app.users.count_active_users()['pending'] == 2
+        users.append(user)
+        # allow hjarka and essun to finish starting
+        for user in users[1:]:
+            user.spawner._start_future.set_result(None)
+        await asyncio.gather(*(u.spawner.wait_spawn() for u in users[1:]))
+        assert all(u.running for u in users)
+
+        # everybody's running, pending count should be back to 0
+        assert app.users.count_active_users()['pending'] == 0
+        for u in users:
+            u.spawner.delay = 0
+        # overlap the cleanup DELETEs instead of serializing them
+        results = await asyncio.gather(
+            *(
+                api_request(app, 'users', u.name, 'server', method='delete')
+                for u in users
+            )
+        )
+        for r in results:
+            r.raise_for_status()
+        await asyncio.gather(*(u.spawner.wait_stop() for u in users))
+        assert not any(u.spawner.active for u in users)
 
 
 @mark.slow
-async def test_active_server_limit(app, request):
+async def test_active_server_limit(app):
     db = app.db
-    p = mock.patch.dict(app.tornado_settings, {'active_server_limit': 2})
-    p.start()
-    request.addfinalizer(p.stop)
-
-    # start two pending spawns
-    names = ['ykka', 'hjarka']
-    users = [add_user(db, app=app, name=name) for name in names]
-    for name in names:
+    with override_settings(app, active_server_limit=2):
+        # start two pending spawns
+        names = ['ykka', 'hjarka']
+        users = bulk_add_users(db, names, app=app)
+        for name in names:
+            r = await api_request(app, 'users', name, 'server', method='post')
+            r.raise_for_status()
+        counts = app.users.count_active_users()
+        assert counts['active'] == 2
+        assert counts['ready'] == 2
+        assert counts['pending'] == 0
+
+        # ykka and hjarka's servers are running. Essun should fail with 429
+        name = 'essun'
+        user = add_user(db, app=app, name=name)
         r = await api_request(app, 'users', name, 'server', method='post')
-        r.raise_for_status()
-    counts = app.users.count_active_users()
-    assert counts['active'] == 2
-    assert counts['ready'] == 2
-    assert counts['pending'] == 0
-
-    # ykka and hjarka's servers are running. Essun should fail with 429
-    name = 'essun'
-    user = add_user(db, app=app, name=name)
-    r = await api_request(app, 'users', name, 'server', method='post')
-    assert r.status_code == 429
-    counts = app.users.count_active_users()
-    assert counts['active'] == 2
-    assert counts['ready'] == 2
-    assert counts['pending'] == 0
+        assert r.status_code == 429
+        counts = app.users.count_active_users()
+        assert counts['active'] == 2
+        assert counts['ready'] == 2
+        assert counts['pending'] == 0
+
+        # stop one server
+        await api_request(app, 'users', names[0], 'server', method='delete')
+        counts = app.users.count_active_users()
+        assert counts['active'] == 1
+        assert counts['ready'] == 1
+        assert counts['pending'] == 0
 
-    # stop one server
-    await api_request(app, 'users', names[0], 'server', method='delete')
-    counts = app.users.count_active_users()
-    assert counts['active'] == 1
-    assert counts['ready'] == 1
-    assert counts['pending'] == 0
-
-    r = await api_request(app, 'users', name, 'server', method='post')
-    r.raise_for_status()
-    counts = app.users.count_active_users()
-    assert counts['active'] == 2
-    assert counts['ready'] == 2
-    assert counts['pending'] == 0
-    users.append(user)
-
-    # everybody's running, pending count should be back to 0
-    assert app.users.count_active_users()['pending'] == 0
-    for u in users:
-        if not u.spawner.active:
-            continue
-        r = await api_request(app, 'users', u.name, 'server', method='delete')
+        r = await api_request(app, 'users', name, 'server', method='post')
         r.raise_for_status()
+        counts = app.users.count_active_users()
+        assert counts['active'] == 2
+        assert counts['ready'] == 2
+        assert counts['pending'] == 0
+        users.append(user)
+
+        # everybody's running, pending count is 0 per the counts above
+        # overlap the cleanup DELETEs instead of serializing them
+        results = await asyncio.gather(
+            *(
+                api_request(app, 'users', u.name, 'server', method='delete')
+                for u in users
+                if u.spawner.active
+            )
+        )
+        for r in results:
+            r.raise_for_status()
 
-    counts = app.users.count_active_users()
-    assert counts['active'] == 0
-    assert counts['ready'] == 0
-    assert counts['pending'] == 0
+        counts = app.users.count_active_users()
+        assert counts['active'] == 0
+        assert counts['ready'] == 0
+        assert counts['pending'] == 0
 
 
 @mark.slow
@@ -1651,8 +1658,8 @@ async def test_start_stop_race(app, no_patience, slow_spawn):
         r = await api_request(app, 'users', user.name, 'server', method='post')
     assert r.status_code == 400
 
-    while spawner.active:
-        await asyncio.sleep(0.1)
+    await spawner.wait_stop()
+    assert not spawner.active
     # start after stop is okay
     r = await api_request(app, 'users', user.name, 'server', method='post')
     assert r.status_code == 202
@@ -1665,15 +1672,17 @@ async def test_get_proxy(app):
     assert list(reply.keys()) == [app.hub.routespec]
 
 
-@mark.parametrize("offset", (0, 1))
-async def test_get_proxy_pagination(app, offset):
-    r = await api_request(
-        app, f'proxy?offset={offset}', headers={"Accept": PAGINATION_MEDIA_TYPE}
-    )
-    r.raise_for_status()
-    reply = r.json()
-    assert set(reply) == {"items", "_pagination"}
-    assert list(reply["items"].keys()) == [app.hub.routespec][offset:]
+async def test_get_proxy_pagination(app):
+    # both offsets in one test: the setup is shared
+    # and each check is a single request
+    for offset in (0, 1):
+        r = await api_request(
+            app, f'proxy?offset={offset}', headers={"Accept": PAGINATION_MEDIA_TYPE}
+        )
+        r.raise_for_status()
+        reply = r.json()
+        assert set(reply) == {"items", "_pagination"}, offset
+        assert list(reply["items"].keys()) == [app.hub.routespec][offset:], offset
 
 
 async def test_cookie(app):
@@ -1724,13 +1733,13 @@ async def test_check_token(app):
     assert r.status_code == 404
 
 
-@mark.parametrize("headers, status", [({}, 404), ({'Authorization': 'token bad'}, 404)])
-async def test_get_new_token_deprecated(app, headers, status):
-    # request a new token
-    r = await api_request(
-        app, 'authorizations', 'token', method='post', headers=headers
-    )
-    assert r.status_code == status
+async def test_get_new_token_deprecated(app):
+    # request a new token; both header cases share the same setup
+    for headers in ({}, {'Authorization': 'token bad'}):
+        r = await api_request(
+            app, 'authorizations', 'token', method='post', headers=headers
+        )
+        assert r.status_code == 404, headers
 
 
 @mark.parametrize(
@@ -1748,7 +1757,7 @@ async def test_get_new_token(app, headers, status, note, expires_in):
     if expires_in:
         options['expires_in'] = expires_in
     if options:
-        body = json.dumps(options)
+        body = json_dumps(options)
     else:
         body = ''
     # request a new token
@@ -1807,14 +1816,12 @@ async def test_token_expires_in_max(app, user, expires_in_max, expires_in, expec
         "expires_in": expires_in,
     }
     # request a new token
-    with mock.patch.dict(
-        app.tornado_settings, {"token_expires_in_max_seconds": expires_in_max}
-    ):
+    with override_settings(app, token_expires_in_max_seconds=expires_in_max):
         r = await api_request(
             app,
             f'users/{user.name}/tokens',
             method='post',
-            data=json.dumps(options),
+            data=json_dumps(options),
         )
     if expected == 'error':
         assert r.status_code == 400
@@ -1846,14 +1853,15 @@ async def test_token_for_user(app, as_user, for_user, status):
     if for_user != 'missing':
         for_user_obj = add_user(app.db, app, name=for_user)
     data = {'username': for_user}
-    headers = {'Authorization': f'token {u.new_api_token()}'}
+    # admin/user tokens are minted once and cached by auth_header
+    headers = auth_header(app.db, as_user)
     r = await api_request(
         app,
         'users',
         for_user,
         'tokens',
         method='post',
-        data=json.dumps(data),
+        data=json_dumps(data),
         headers=headers,
     )
     assert r.status_code == status
@@ -1893,7 +1901,7 @@ async def test_token_authenticator_noauth(app):
         name,
         'tokens',
         method='post',
-        data=json.dumps(data) if data else None,
+        data=json_dumps(data) if data else None,
         noauth=True,
     )
     assert r.status_code == 201
@@ -1916,7 +1924,7 @@ async def test_token_authenticator_dict_noauth(app):
         name,
         'tokens',
         method='post',
-        data=json.dumps(data) if data else None,
+        data=json_dumps(data) if data else None,
         noauth=True,
     )
     assert r.status_code == 201
@@ -1941,7 +1949,8 @@ async def test_token_list(app, as_user, for_user, status):
     u = add_user(app.db, app, name=as_user)
     if for_user != 'missing':
         for_user_obj = add_user(app.db, app, name=for_user)
-    headers = {'Authorization': f'token {u.new_api_token()}'}
+    # admin/user tokens are minted once and cached by auth_header
+    headers = auth_header(app.db, as_user)
     r = await api_request(app, 'users', for_user, 'tokens', headers=headers)
     assert r.status_code == status
     if status != 200:
@@ -1950,14 +1959,20 @@ async def test_token_list(app, as_user, for_user, status):
     assert sorted(reply) == ['api_tokens']
     assert len(reply['api_tokens']) == len(for_user_obj.api_tokens)
     assert all(token['user'] == for_user for token in reply['api_tokens'])
-    # validate individual token ids
-    for token in reply['api_tokens']:
-        r = await api_request(
-            app, 'users', for_user, 'tokens', token['id'], headers=headers
+    # normalize each listed token once, keyed by id
+    normalized_by_id = {
+        token['id']: normalize_token(token) for token in reply['api_tokens']
+    }
+    # validate individual token ids, overlapping the requests
+    responses = await asyncio.gather(
+        *(
+            api_request(app, 'users', for_user, 'tokens', token_id, headers=headers)
+            for token_id in normalized_by_id
         )
+    )
+    for token_id, r in zip(normalized_by_id, responses):
         r.raise_for_status()
-        reply = r.json()
-        assert normalize_token(reply) == normalize_token(token)
+        assert normalize_token(r.json()) == normalized_by_id[token_id]
 
 
 # ---------------
@@ -1965,6 +1980,24 @@ async def test_token_list(app, as_user, for_user, status):
 # ---------------
 
 
+# empty group models as returned by the groups API,
+# shared by the assertions in test_groups_list
+_empty_alphaflight = {
+    'kind': 'group',
+    'name': 'alphaflight',
+    'users': [],
+    'roles': [],
+    'properties': {},
+}
+_empty_betaflight = {
+    'kind': 'group',
+    'name': 'betaflight',
+    'users': [],
+    'roles': [],
+    'properties': {},
+}
+
+
 @mark.group
 async def test_groups_list(app):
     r = await api_request(app, 'groups')
@@ -1983,20 +2016,8 @@ async def test_groups_list(app):
     r.raise_for_status()
     reply = r.json()
     assert reply == [
-        {
-            'kind': 'group',
-            'name': 'alphaflight',
-            'users': [],
-            'roles': [],
-            'properties': {},
-        },
-        {
-            'kind': 'group',
-            'name': 'betaflight',
-            'users': [],
-            'roles': [],
-            'properties': {},
-        },
+        _empty_alphaflight,
+        _empty_betaflight,
     ]
 
     # Test offset for pagination
@@ -2004,15 +2025,7 @@ async def test_groups_list(app):
     r.raise_for_status()
     reply = r.json()
     assert r.status_code == 200
-    assert reply == [
-        {
-            'kind': 'group',
-            'name': 'betaflight',
-            'users': [],
-            'roles': [],
-            'properties': {},
-        }
-    ]
+    assert reply == [_empty_betaflight]
 
     r = await api_request(app, "groups?offset=10")
     r.raise_for_status()
@@ -2024,29 +2037,13 @@ async def test_groups_list(app):
     r.raise_for_status()
     reply = r.json()
     assert r.status_code == 200
-    assert reply == [
-        {
-            'kind': 'group',
-            'name': 'alphaflight',
-            'users': [],
-            'roles': [],
-            'properties': {},
-        }
-    ]
+    assert reply == [_empty_alphaflight]
 
     # 0 is rounded up to 1
     r = await api_request(app, "groups?limit=0")
     r.raise_for_status()
     reply = r.json()
-    assert reply == [
-        {
-            'kind': 'group',
-            'name': 'alphaflight',
-            'users': [],
-            'roles': [],
-            'properties': {},
-        }
-    ]
+    assert reply == [_empty_alphaflight]
 
 
 @mark.group
@@ -2054,7 +2051,7 @@ async def test_add_multi_group(app):
     db = app.db
     names = ['group1', 'group2']
     r = await api_request(
-        app, 'groups', method='post', data=json.dumps({'groups': names})
+        app, 'groups', method='post', data=json_dumps({'groups': names})
     )
     assert r.status_code == 201
     reply = r.json()
@@ -2063,7 +2060,7 @@ async def test_add_multi_group(app):
 
     # try to create the same groups again
     r = await api_request(
-        app, 'groups', method='post', data=json.dumps({'groups': names})
+        app, 'groups', method='post', data=json_dumps({'groups': names})
     )
     assert r.status_code == 409
 
@@ -2101,7 +2098,7 @@ async def test_group_create_delete(app):
     assert r.status_code == 404
 
     r = await api_request(
-        app, 'groups/new', method='post', data=json.dumps({'users': ['doesntexist']})
+        app, 'groups/new', method='post', data=json_dumps({'users': ['doesntexist']})
     )
     assert r.status_code == 400
     assert orm.Group.find(db, name='new') is None
@@ -2110,12 +2107,13 @@ async def test_group_create_delete(app):
         app,
         'groups/omegaflight',
         method='post',
-        data=json.dumps({'users': ['sasquatch']}),
+        data=json_dumps({'users': ['sasquatch']}),
     )
     r.raise_for_status()
 
     omegaflight = orm.Group.find(db, name='omegaflight')
-    sasquatch = find_user(db, name='sasquatch')
+    # reuse the user created above instead of re-querying
+    sasquatch = user.orm_user
     assert omegaflight in sasquatch.groups
     assert sasquatch in omegaflight.users
 
@@ -2144,36 +2142,58 @@ async def test_group_add_delete_users(app):
     assert r.status_code == 400
 
     names = ['aurora', 'guardian', 'northstar', 'sasquatch', 'shaman', 'snowbird']
-    users = [add_user(db, app=app, name=name) for name in names]
+    bulk_add_users(db, names)
     r = await api_request(
         app,
         'groups/alphaflight/users',
         method='post',
-        data=json.dumps({'users': names}),
+        data=json_dumps({'users': names}),
     )
     r.raise_for_status()
 
-    for user in users:
-        print(user.name)
-        assert [g.name for g in user.groups] == ['alphaflight']
+    # one join query instead of a per-user relationship load
+    rows = (
+        db.query(orm.User.name, orm.Group.name)
+        .select_from(orm.User)
+        .join(orm.User.groups)
+        .filter(orm.User.name.in_(names))
+        .all()
+    )
+    assert set(rows) == {(name, 'alphaflight') for name in names}
 
-    group = orm.Group.find(db, name='alphaflight')
+    # selectinload: fetch the group and its membership in one batched query
+    group = (
+        db.query(orm.Group)
+        .options(selectinload(orm.Group.users))
+        .filter_by(name='alphaflight')
+        .one()
+    )
     assert sorted(u.name for u in group.users) == sorted(names)
 
     r = await api_request(
         app,
         'groups/alphaflight/users',
         method='delete',
-        data=json.dumps({'users': names[:2]}),
+        data=json_dumps({'users': names[:2]}),
     )
     r.raise_for_status()
 
-    for user in users[:2]:
-        assert user.groups == []
-    for user in users[2:]:
-        assert [g.name for g in user.groups] == ['alphaflight']
+    # removed users produce no rows in the inner join
+    rows = (
+        db.query(orm.User.name, orm.Group.name)
+        .select_from(orm.User)
+        .join(orm.User.groups)
+        .filter(orm.User.name.in_(names))
+        .all()
+    )
+    assert set(rows) == {(name, 'alphaflight') for name in names[2:]}
 
-    group = orm.Group.find(db, name='alphaflight')
+    group = (
+        db.query(orm.Group)
+        .options(selectinload(orm.Group.users))
+        .filter_by(name='alphaflight')
+        .one()
+    )
     assert sorted(u.name for u in group.users) == sorted(names[2:])
 
 
@@ -2189,7 +2209,7 @@ async def test_group_add_delete_users(app):
 @mark.group
 async def test_group_properties_invalid(app, group, properties):
     if properties:
-        json_properties = json.dumps(properties)
+        json_properties = json_dumps(properties)
     else:
         json_properties = ""
     have_properties = {"a": 5}
@@ -2216,7 +2236,7 @@ async def test_group_properties(app, group):
         app,
         f"groups/{group.name}/properties",
         method='put',
-        data=json.dumps(properties),
+        data=json_dumps(properties),
     )
     r.raise_for_status()
     assert group.properties == properties
@@ -2242,7 +2262,7 @@ async def test_auth_managed_groups(request, app, group, user):
         app,
         'groups',
         method='post',
-        data=json.dumps({"groups": {"groupname": [user.name]}}),
+        data=json_dumps({"groups": {"groupname": [user.name]}}),
     )
     assert r.status_code == 201
     r = await api_request(app, 'groups/newgroup', method='post')
@@ -2252,7 +2272,7 @@ async def test_auth_managed_groups(request, app, group, user):
         app,
         f'groups/{group.name}/users',
         method='post',
-        data=json.dumps({"users": [user.name]}),
+        data=json_dumps({"users": [user.name]}),
     )
     assert r.status_code == 200
     # remove users from group
@@ -2260,7 +2280,7 @@ async def test_auth_managed_groups(request, app, group, user):
         app,
         f'groups/{group.name}/users',
         method='delete',
-        data=json.dumps({"users": [user.name]}),
+        data=json_dumps({"users": [user.name]}),
     )
     assert r.status_code == 200
     # delete groups
@@ -2349,7 +2369,7 @@ async def test_create_service(app, service_admin_user, service_name, service_dat
         app,
         f'services/{service_name}',
         headers=auth_header(db, service_admin_user.name),
-        data=json.dumps(service_data),
+        data=json_dumps(service_data),
         method='post',
     )
 
@@ -2380,7 +2400,7 @@ async def test_create_service_no_role(app, service_name, service_data):
         app,
         f'services/{service_name}',
         headers=auth_header(db, 'user'),
-        data=json.dumps(service_data),
+        data=json_dumps(service_data),
         method='post',
     )
 
@@ -2399,7 +2419,7 @@ async def test_create_service_conflict(
         app,
         f'services/{service_name}',
         headers=auth_header(db, service_admin_user.name),
-        data=json.dumps(service_data),
+        data=json_dumps(service_data),
         method='post',
     )
 
@@ -2416,7 +2436,7 @@ async def test_create_service_duplication(
         app,
         f'services/{service_name}',
         headers=auth_header(db, service_admin_user.name),
-        data=json.dumps(service_data),
+        data=json_dumps(service_data),
         method='post',
     )
     assert r.status_code == 201
@@ -2425,7 +2445,7 @@ async def test_create_service_duplication(
         app,
         f'services/{service_name}',
         headers=auth_header(db, service_admin_user.name),
-        data=json.dumps(service_data),
+        data=json_dumps(service_data),
         method='post',
     )
     assert r.status_code == 409
@@ -2436,13 +2456,14 @@ async def test_create_managed_service(
     app, service_admin_user, service_name, service_data
 ):
     db = app.db
-    managed_service_data = deepcopy(service_data)
-    managed_service_data['command'] = ['foo']
+    # service_data is per-test and flat: a shallow copy with
+    # overrides is enough, no deepcopy walk needed
+    managed_service_data = dict(service_data, command=['foo'])
     r = await api_request(
         app,
         f'services/{service_name}',
         headers=auth_header(db, service_admin_user.name),
-        data=json.dumps(managed_service_data),
+        data=json_dumps(managed_service_data),
         method='post',
     )
 
@@ -2455,13 +2476,12 @@ async def test_create_managed_service(
 @mark.services
 async def test_create_admin_service(app, admin_user, service_name, service_data):
     db = app.db
-    managed_service_data = deepcopy(service_data)
-    managed_service_data['admin'] = True
+    managed_service_data = dict(service_data, admin=True)
     r = await api_request(
         app,
         f'services/{service_name}',
         headers=auth_header(db, admin_user.name),
-        data=json.dumps(managed_service_data),
+        data=json_dumps(managed_service_data),
         method='post',
     )
 
@@ -2475,13 +2495,12 @@ async def test_create_admin_service_without_admin_right(
     app, service_admin_user, service_data, service_name
 ):
     db = app.db
-    managed_service_data = deepcopy(service_data)
-    managed_service_data['admin'] = True
+    managed_service_data = dict(service_data, admin=True)
     r = await api_request(
         app,
         f'services/{service_name}',
         headers=auth_header(db, service_admin_user.name),
-        data=json.dumps(managed_service_data),
+        data=json_dumps(managed_service_data),
         method='post',
     )
 
@@ -2496,15 +2515,17 @@ async def test_create_service_with_scope(
     app, create_user_with_scopes, service_name, service_data
 ):
     db = app.db
-    managed_service_data = deepcopy(service_data)
-    managed_service_data['oauth_client_allowed_scopes'] = ["admin:users"]
-    managed_service_data['oauth_client_id'] = "service-client-with-scope"
+    managed_service_data = dict(
+        service_data,
+        oauth_client_allowed_scopes=["admin:users"],
+        oauth_client_id="service-client-with-scope",
+    )
     user_with_scope = create_user_with_scopes('admin:services', 'admin:users')
     r = await api_request(
         app,
         f'services/{service_name}',
         headers=auth_header(db, user_with_scope.name),
-        data=json.dumps(managed_service_data),
+        data=json_dumps(managed_service_data),
         method='post',
     )
 
@@ -2521,13 +2542,14 @@ async def test_create_service_without_requested_scope(
     service_name,
 ):
     db = app.db
-    managed_service_data = deepcopy(service_data)
-    managed_service_data['oauth_client_allowed_scopes'] = ["admin:users"]
+    managed_service_data = dict(
+        service_data, oauth_client_allowed_scopes=["admin:users"]
+    )
     r = await api_request(
         app,
         f'services/{service_name}',
         headers=auth_header(db, service_admin_user.name),
-        data=json.dumps(managed_service_data),
+        data=json_dumps(managed_service_data),
         method='post',
     )
 
@@ -2544,7 +2566,7 @@ async def test_delete_service(app, service_admin_user, service_name, service_dat
         app,
         f'services/{service_name}',
         headers=auth_header(db, service_admin_user.name),
-        data=json.dumps(service_data),
+        data=json_dumps(service_data),
         method='post',
     )
     assert r.status_code == 201
@@ -2599,7 +2621,7 @@ async def test_root_api(app):
 
 
 async def test_info(app):
-    r = await api_request(app, 'info')
+    r = await api_request(app, 'info', bypass_proxy=True)
     r.raise_for_status()
     data = r.json()
     assert data['version'] == jupyterhub.__version__
@@ -2635,6 +2657,7 @@ async def test_update_activity_403(app, user, admin_user):
         headers={"Authorization": f"token {token}"},
         data="{}",
         method="post",
+        bypass_proxy=True,
     )
     assert r.status_code == 404
 
@@ -2645,66 +2668,62 @@ async def test_update_activity_admin(app, user, admin_user):
         app,
         f"users/{user.name}/activity",
         headers={"Authorization": f"token {token}"},
-        data=json.dumps({"last_activity": utcnow().isoformat()}),
+        data=json_dumps({"last_activity": utcnow().isoformat()}),
         method="post",
+        bypass_proxy=True,
     )
     r.raise_for_status()
 
 
-@mark.parametrize(
-    "server_name, fresh",
-    [
-        ("", True),
-        ("", False),
-        ("exists", True),
-        ("exists", False),
-        ("nope", True),
-        ("nope", False),
-    ],
-)
-async def test_update_server_activity(app, user, server_name, fresh):
+async def test_update_server_activity(app, user):
+    # run the whole (server_name, fresh) matrix against one user,
+    # creating the user and token once;
+    # only the last_activity baselines are reset per case
     token = user.new_api_token()
-    now = utcnow()
-    internal_now = now.replace(tzinfo=None)
-    # we use naive utc internally
-    # initialize last_activity for one named and the default server
-    for name in ("", "exists"):
-        user.spawners[name].orm_spawner.last_activity = internal_now
-    app.db.commit()
-
     td = timedelta(minutes=1)
-    if fresh:
-        activity = now + td
-    else:
-        activity = now - td
-
-    r = await api_request(
-        app,
-        f"users/{user.name}/activity",
-        headers={"Authorization": f"token {token}"},
-        data=json.dumps(
-            {"servers": {server_name: {"last_activity": activity.isoformat()}}}
-        ),
-        method="post",
-    )
-    if server_name == "nope":
-        assert r.status_code == 400
-        reply = r.json()
-        assert server_name in reply["message"]
-        assert "No such server" in reply["message"]
-        assert user.name in reply["message"]
-        return
+    for server_name in ("", "exists", "nope"):
+        for fresh in (True, False):
+            now = utcnow()
+            internal_now = now.replace(tzinfo=None)
+            # we use naive utc internally
+            # initialize last_activity for one named and the default server
+            for name in ("", "exists"):
+                user.spawners[name].orm_spawner.last_activity = internal_now
+            app.db.commit()
+
+            if fresh:
+                activity = now + td
+            else:
+                activity = now - td
+
+            r = await api_request(
+                app,
+                f"users/{user.name}/activity",
+                headers={"Authorization": f"token {token}"},
+                data=json_dumps(
+                    {"servers": {server_name: {"last_activity": activity.isoformat()}}}
+                ),
+                method="post",
+                bypass_proxy=True,
+            )
+            if server_name == "nope":
+                assert r.status_code == 400
+                reply = r.json()
+                assert server_name in reply["message"]
+                assert "No such server" in reply["message"]
+                assert user.name in reply["message"]
+                continue
 
-    r.raise_for_status()
+            r.raise_for_status()
 
-    # check that last activity was updated
+            # check that last activity was updated
 
-    if fresh:
-        expected = activity.replace(tzinfo=None)
-    else:
-        expected = now.replace(tzinfo=None)
+            if fresh:
+                expected = activity.replace(tzinfo=None)
+            else:
+                expected = now.replace(tzinfo=None)
 
-    assert user.spawners[server_name].orm_spawner.last_activity == expected
+            assert user.spawners[server_name].orm_spawner.last_activity == expected
 
 
 # -----------------
@@ -2713,13 +2732,15 @@ async def test_update_server_activity(app, user, server_name, fresh):
 
 
 async def test_options(app):
-    r = await api_request(app, 'users', method='options')
+    r = await api_request(app, 'users', method='options', bypass_proxy=True)
     r.raise_for_status()
     assert 'Access-Control-Allow-Headers' in r.headers
 
 
 async def test_bad_json_body(app):
-    r = await api_request(app, 'users', method='post', data='notjson')
+    r = await api_request(
+        app, 'users', method='post', data='notjson', bypass_proxy=True
+    )
     assert r.status_code == 400
 
 
@@ -2739,24 +2760,34 @@ def test_shutdown(app):
             app,
             'shutdown',
             method='post',
-            data=json.dumps({'servers': True, 'proxy': True}),
+            data=json_dumps({'servers': True, 'proxy': True}),
         )
         return r
 
     real_stop = loop.asyncio_loop.stop
-
-    def stop():
-        stop.called = True
-        loop.call_later(2, real_stop)
-
     real_cleanup = app.cleanup
+    cleanup_done = asyncio.Event()
 
-    def cleanup():
+    async def cleanup():
         cleanup.called = True
-        loop.call_later(1, real_cleanup)
+        await real_cleanup()
+        cleanup_done.set()
 
     app.cleanup = cleanup
 
+    def stop():
+        # don't stop the loop yet: the hub's shutdown task is still
+        # cleaning up (and run_sync's own stop also lands here).
+        # chain the real stop off cleanup completing,
+        # instead of a fixed call_later delay.
+        stop.called = True
+
+        async def stop_after_cleanup():
+            await cleanup_done.wait()
+            real_stop()
+
+        asyncio.ensure_future(stop_after_cleanup())
+
     with mock.patch.object(loop.asyncio_loop, 'stop', stop):
         r = loop.run_sync(shutdown, timeout=5)
     r.raise_for_status()
@@ -1,11 +1,10 @@
-from unittest import mock
 from urllib.parse import urlparse
 
 import pytest
 
 from .. import orm
 from ..user import UserDict
-from .utils import add_user
+from .utils import add_user, override_dict
 
 
 @pytest.mark.parametrize("attr", ["self", "id", "name"])
@@ -98,13 +97,11 @@ def test_public_url(app, user, server_name, public_url, subdomain_host, expected
     if public_url:
         public_url = public_url.replace("PREFIX", app.base_url.strip("/"))
         public_url = urlparse(public_url)
-    with mock.patch.dict(
+    with override_dict(
         user.settings,
-        {
-            "subdomain_host": subdomain_host,
-            "domain": urlparse(subdomain_host).hostname,
-            "public_url": public_url,
-        },
+        subdomain_host=subdomain_host,
+        domain=urlparse(subdomain_host).hostname,
+        public_url=public_url,
     ):
         public_server_url = user.public_url(server_name)
     assert public_server_url == expected_url
@@ -2,6 +2,8 @@ import asyncio
 import inspect
 import os
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from weakref import WeakKeyDictionary
 
 import pytest
 import requests
@@ -11,14 +13,47 @@ from tornado.httputil import url_concat
 
 from jupyterhub import metrics, orm
 from jupyterhub.objects import Server
-from jupyterhub.roles import assign_default_roles, update_roles
+from jupyterhub.roles import update_roles
 from jupyterhub.utils import url_path_join as ujoin
 
+try:
+    # encode JSON request bodies with orjson when available,
+    # matching the hub's own API handlers
+    from orjson import dumps as json_dumps
+except ImportError:
+    import json
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf8")
+
+
+class _PooledSession(requests.Session):
+    """Session that reuses connections but does not persist cookies
+
+    Connection pooling avoids a TCP (and TLS, under internal-ssl)
+    handshake per request. Cookies are cleared after every request so
+    shared use still behaves like the stateless module-level requests
+    functions it replaces.
+    """
+
+    def __init__(self):
+        super().__init__()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=20, pool_maxsize=100)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, *args, **kwargs):
+        try:
+            return super().request(*args, **kwargs)
+        finally:
+            self.cookies.clear()
+
 
 class _AsyncRequests:
     """Wrapper around requests to return a Future from request methods
 
     A single thread is allocated to avoid blocking the IOLoop thread.
+    Requests go through a shared connection-pooling session.
     """
 
     def __init__(self):
@@ -27,9 +62,10 @@ class _AsyncRequests:
         self.executor.submit = lambda *args, **kwargs: asyncio.wrap_future(
             real_submit(*args, **kwargs)
         )
+        self.session = _PooledSession()
 
     def __getattr__(self, name):
-        requests_method = getattr(requests, name)
+        requests_method = getattr(self.session, name)
         return lambda *args, **kwargs: self.executor.submit(
             requests_method, *args, **kwargs
         )
@@ -71,6 +107,34 @@ skip_if_ssl = pytest.mark.skipif(
 )
 
 
+# sentinel for keys absent from the overridden dict
+_MISSING = object()
+
+
+@contextmanager
+def override_dict(d, **overrides):
+    """Temporarily override keys in a dict
+
+    Snapshots and restores only the overridden keys,
+    instead of mock.patch.dict's copy of the whole dict.
+    """
+    old = {key: d.get(key, _MISSING) for key in overrides}
+    d.update(overrides)
+    try:
+        yield
+    finally:
+        for key, value in old.items():
+            if value is _MISSING:
+                d.pop(key, None)
+            else:
+                d[key] = value
+
+
+def override_settings(app, **settings):
+    """Temporarily override keys in app.tornado_settings"""
+    return override_dict(app.tornado_settings, **settings)
+
+
 def check_db_locks(func):
     """Decorator that verifies no locks are held on database upon exit.
 
@@ -136,20 +200,99 @@ def add_user(db, app=None, **kwargs):
     if requested_roles:
         update_roles(db, entity=orm_user, roles=requested_roles)
     else:
-        assign_default_roles(db, entity=orm_user)
+        # inline assign_default_roles with the cached default roles,
+        # avoiding two Role.find SELECTs per created user
+        user_role = get_role(db, 'user')
+        admin_role = get_role(db, 'admin')
+        if orm_user.admin:
+            if admin_role not in orm_user.roles:
+                orm_user.roles.append(admin_role)
+        elif admin_role in orm_user.roles:
+            orm_user.roles.remove(admin_role)
+        if user_role not in orm_user.roles:
+            orm_user.roles.append(user_role)
+        db.commit()
     if app:
         return app.users[orm_user.id]
     else:
         return orm_user
 
 
+def bulk_add_users(db, names, app=None):
+    """Add many users to the database at once
+
+    Much faster than calling `add_user` in a loop:
+    one bulk INSERT plus one role-assignment commit,
+    instead of per-user commits and role queries.
+
+    Returns the orm.User objects in insertion (id) order,
+    or the wrapped `app.users` objects if `app` is given,
+    matching `add_user`.
+    """
+    db.bulk_insert_mappings(orm.User, [{"name": name} for name in names])
+    db.commit()
+    users = (
+        db.query(orm.User)
+        .filter(orm.User.name.in_(names))
+        .order_by(orm.User.id.asc())
+        .all()
+    )
+    # assign the default 'user' role in one pass
+    user_role = get_role(db, 'user')
+    user_role.users.extend(users)
+    db.commit()
+    metrics.TOTAL_USERS.inc(len(users))
+    if app:
+        return [app.users[orm_user.id] for orm_user in users]
+    return users
+
+
+# role cache for get_role, keyed weakly by db session.
+# the default roles are created once at Hub startup and never change,
+# but orm.Role.find issues a SELECT per call.
+_role_cache = WeakKeyDictionary()
+
+
+def get_role(db, name):
+    """Find a role by name, cached per db session
+
+    For roles that live for the whole test session (e.g. the default
+    'user' and 'admin' roles); use orm.Role.find directly for roles a
+    test creates and deletes.
+    """
+    cache = _role_cache.setdefault(db, {})
+    role = cache.get(name)
+    if role is None:
+        role = cache[name] = orm.Role.find(db, name)
+    return role
+
+
+# minted-token cache for auth_header, keyed weakly by db session.
+# only the permanent 'admin' and 'user' accounts are cached:
+# transient test users can be deleted and recreated under the same name,
+# which would leave a cached token pointing at a deleted row.
+_auth_header_cache = WeakKeyDictionary()
+_auth_header_cacheable = {'admin', 'user'}
+
+
 def auth_header(db, name):
-    """Return header with user's API authorization token."""
-    user = find_user(db, name)
-    if user is None:
-        raise KeyError(f"No such user: {name}")
-    token = user.new_api_token()
-    return {'Authorization': f'token {token}'}
+    """Return header with user's API authorization token.
+
+    Tokens for the permanent test users are minted once per db session
+    instead of inserting a fresh API token on every call.
+    """
+    cache = _auth_header_cache.setdefault(db, {})
+    header = cache.get(name)
+    if header is None:
+        user = find_user(db, name)
+        if user is None:
+            raise KeyError(f"No such user: {name}")
+        token = user.new_api_token()
+        header = {'Authorization': f'token {token}'}
+        if name in _auth_header_cacheable:
+            cache[name] = header
+    # copy: callers add headers to the returned dict
+    return dict(header)
 
 
 @check_db_locks